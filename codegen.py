@@ -1,3 +1,7 @@
+import ctypes
+import functools
+import math
+import llvmlite.binding as llvm
 import llvmlite.ir
 import parser
 
@@ -5,72 +9,222 @@ from llvmlite.ir import IRBuilder, Module, Value, Context, Constant, FunctionTyp
 
 DoubleType = llvmlite.ir.DoubleType()
 
+_FN_TYPES = tuple(FunctionType(DoubleType, (DoubleType,) * num_args) for num_args in range(16))
+_FN_TYPE_CACHE = {}
+_MISSING = object()
+
+
+def function_type(num_args):
+    """Return the double(double, ...) function type of given arity, cached."""
+    if num_args < len(_FN_TYPES):
+        return _FN_TYPES[num_args]
+    fn_type = _FN_TYPE_CACHE.get(num_args)
+    if fn_type is None:
+        fn_type = _FN_TYPE_CACHE[num_args] = FunctionType(DoubleType, (DoubleType,) * num_args)
+    return fn_type
+
+
+def double_constant(value):
+    """Return a double constant, cached by value."""
+    # 0.0 == -0.0, so key on the sign as well
+    return _double_constant(value, math.copysign(1.0, value))
+
+
+@functools.lru_cache(maxsize=1024)
+def _double_constant(value, sign):
+    return Constant(DoubleType, value)
+
+
+llvm.initialize()
+llvm.initialize_native_target()
+llvm.initialize_native_asmprinter()
+
+_TM = llvm.Target.from_default_triple().create_target_machine()
+
+
+@functools.lru_cache(maxsize=None)
+def _module_pass_manager(opt_level):
+    pmb = llvm.create_pass_manager_builder()
+    pmb.opt_level = opt_level
+    pm = llvm.create_module_pass_manager()
+    _TM.add_analysis_passes(pm)
+    pmb.populate(pm)
+    return pm
+
+
+def optimize(module, opt_level=3):
+    """Run LLVM optimization passes over module, return the optimized ModuleRef."""
+    mod_ref = llvm.parse_assembly(str(module))
+    mod_ref.triple = _TM.triple
+    mod_ref.data_layout = str(_TM.target_data)
+    mod_ref.verify()
+    _module_pass_manager(opt_level).run(mod_ref)
+    return mod_ref
+
+
 class CodegenError(Exception):
     pass
 
 
+def _callees(fn):
+    """Return the distinct functions called from the body of fn."""
+    callees = {}
+    for block in fn.blocks:
+        for instr in block.instructions:
+            if isinstance(instr, llvmlite.ir.CallInstr):
+                callees.setdefault(instr.callee.name, instr.callee)
+    return callees.values()
+
+
+class JITEngine:
+    """MCJIT engine fed one function at a time, each in its own module.
+
+    Definitions are kept as IR and only compiled and linked into the engine
+    once an expression that needs them is run, so functions may call others
+    that are declared with extern and defined later.
+    """
+
+    def __init__(self, opt_level=3):
+        self.engine = llvm.create_mcjit_compiler(llvm.parse_assembly(""), _TM)
+        self.opt_level = opt_level
+        self._pending = {}  # name -> (ir.Function, names of callees)
+        self._linked = set()
+
+    def add_function(self, fn):
+        """Remember fn, to be compiled and linked when first needed."""
+        self._pending[fn.name] = (fn, {callee.name for callee in _callees(fn)})
+
+    def run(self, fn):
+        """Link fn and everything it calls, call it and return its result."""
+        for name in self._unlinked_dependencies(callee.name for callee in _callees(fn)):
+            self.engine.add_module(self._compile(self._pending.pop(name)[0]))
+            self._linked.add(name)
+        self.engine.add_module(self._compile(fn))
+        self.engine.finalize_object()
+        address = self.engine.get_function_address(fn.name)
+        return ctypes.CFUNCTYPE(ctypes.c_double)(address)()
+
+    def _compile(self, fn):
+        decls = Module()
+        for callee in _callees(fn):
+            if callee is not fn:
+                Function(decls, callee.ftype, callee.name)
+        mod_ref = llvm.parse_assembly(str(decls) + str(fn))
+        mod_ref.triple = _TM.triple
+        mod_ref.data_layout = str(_TM.target_data)
+        mod_ref.verify()
+        _module_pass_manager(self.opt_level).run(mod_ref)
+        return mod_ref
+
+    def _unlinked_dependencies(self, callees):
+        """Collect pending definitions reachable from callees, checking all resolve."""
+        needed = []
+        seen = set()
+        stack = list(callees)
+        while stack:
+            name = stack.pop()
+            if name in seen or name in self._linked:
+                continue
+            seen.add(name)
+            if name in self._pending:
+                needed.append(name)
+                stack.extend(self._pending[name][1])
+            elif llvm.address_of_symbol(name) is None:
+                raise CodegenError(f"Function {name} is declared but never defined")
+        return needed
+
+
 class IRGenerator:
     def __init__(self):
         self.builder = IRBuilder()
         self.module = Module()
+        self._fn_index = {}
+        self._dispatch = {
+            parser.VariableExpr: self._gen_variable,
+            parser.NumebrExpr: self._gen_number,
+            parser.BinaryOpExpr: self._gen_binop,
+            parser.CallExpr: self._gen_call,
+            parser.Prototype: self._gen_proto,
+            parser.Function: self._gen_function,
+        }
+        self._arith_ops = {
+            "+": (self.builder.fadd, "addtmp"),
+            "-": (self.builder.fsub, "subtmp"),
+            "*": (self.builder.fmul, "multmp"),
+        }
 
     def search_functions(self, name, num_args):
-        for function in self.module.functions:
-            if function.name == name and len(function.args) == num_args:
-                return function
-        return None
-
-    def generate(self, node, lookup={}):
-        if isinstance(node, parser.VariableExpr):
-            if node.var_name in lookup:
-                return lookup[node.var_name]
-            else:
-                raise CodegenError(f"Undefined variable {node.var_name}")
-        elif isinstance(node, parser.NumebrExpr):
-            return DoubleType(node.value)
-        elif isinstance(node, parser.BinaryOpExpr):
-            lhs = self.generate(node.lhs, lookup)
-            rhs = self.generate(node.rhs, lookup)
-            if node.op == "+":
-                return self.builder.fadd(lhs, rhs, name="addtmp")
-            elif node.op == "-":
-                return self.builder.fsub(lhs, rhs, name="subtmp")
-            elif node.op == "<":
-                tmp = self.builder.fcmp_unordered('<', lhs, rhs, name="tmpcmp")
-                return self.builder.uitofp(tmp, DoubleType, name="booltmp")
-            elif node.op == "*":
-                return self.builder.fmul(lhs, rhs, name="multmp")
-            else:
-                return CodegenError(f"Invalid binary operation {node.op}")
-        elif isinstance(node, parser.CallExpr):
-            fn = self.search_functions(node.callee, len(node.args))
-            if fn is None:
-                return CodegenError(f"Function {node.name} of {len(node.args)} arguments not found")
-            args = []
-            for arg in node.args:
-                args.append(self.generate(arg, lookup))
-            return self.builder.call(fn, args, name="calltmp")
-        elif isinstance(node, parser.Prototype):
-            fn_type = FunctionType(DoubleType, [DoubleType] * len(node.args))
-            fn = Function(self.module, fn_type, node.name)
-            fn.linkage = ""  # this means external linkage
-            for arg, arg_name in zip(fn.args, node.args):
-                arg.name = arg_name
-            return fn
-        elif isinstance(node, parser.Function):
-            fn = self.search_functions(node.proto.name, len(node.proto.args))
-            if fn is None:
-                fn = self.generate(node.proto, lookup)
-            if len(fn.blocks) > 0:
-                raise CodegenError(f"Cannot redefine function {node.proto}")
-            bb = fn.append_basic_block("entry")
-            self.builder.position_at_end(bb)
-            lookup_add = {arg.name: arg for arg in fn.args}
-            ret = self.generate(node.body, lookup={**lookup, **lookup_add})
-            self.builder.ret(ret)
-            return fn
+        return self._fn_index.get((name, num_args))
+
+    def generate(self, node, lookup=None):
+        if lookup is None:
+            lookup = {}
+        handler = self._dispatch.get(type(node))
+        if handler is None:
+            raise CodegenError(f"Cannot generate code for {type(node).__name__}")
+        return handler(node, lookup)
+
+    def _gen_variable(self, node, lookup):
+        if node.var_name in lookup:
+            return lookup[node.var_name]
+        else:
+            raise CodegenError(f"Undefined variable {node.var_name}")
+
+    def _gen_number(self, node, lookup):
+        return double_constant(node.value)
+
+    def _gen_binop(self, node, lookup):
+        lhs = self.generate(node.lhs, lookup)
+        rhs = self.generate(node.rhs, lookup)
+        arith_op = self._arith_ops.get(node.op)
+        if arith_op is not None:
+            build, name = arith_op
+            return build(lhs, rhs, name=name, flags=("fast",))
+        elif node.op == "<":
+            tmp = self.builder.fcmp_ordered('<', lhs, rhs, name="tmpcmp")
+            return self.builder.select(tmp, double_constant(1.0), double_constant(0.0), name="booltmp")
         else:
-            print("WATAFAK")
-            print(type(node))
-            print(parser.Function)
-        print("End")
+            raise CodegenError(f"Invalid binary operation {node.op}")
+
+    def _gen_call(self, node, lookup):
+        fn = self.search_functions(node.callee, len(node.args))
+        if fn is None:
+            raise CodegenError(f"Function {node.callee} of {len(node.args)} arguments not found")
+        return self.builder.call(fn, [self.generate(arg, lookup) for arg in node.args], name="calltmp")
+
+    def _gen_proto(self, node, lookup):
+        if node.name in self.module.globals:
+            raise CodegenError(f"Function {node.name} is already declared")
+        fn_type = function_type(len(node.args))
+        fn = Function(self.module, fn_type, node.name)
+        self._fn_index[(node.name, len(node.args))] = fn
+        fn.linkage = ""  # this means external linkage
+        for arg, arg_name in zip(fn.args, node.args):
+            arg.name = arg_name
+        return fn
+
+    def _gen_function(self, node, lookup):
+        fn = self.search_functions(node.proto.name, len(node.proto.args))
+        if fn is None:
+            fn = self.generate(node.proto, lookup)
+        if len(fn.blocks) > 0:
+            raise CodegenError(f"Cannot redefine function {node.proto}")
+        bb = fn.append_basic_block("entry")
+        self.builder.position_at_end(bb)
+        # bind arguments in place and restore whatever they shadowed afterwards
+        shadowed = [(arg.name, lookup.get(arg.name, _MISSING)) for arg in fn.args]
+        lookup.update((arg.name, arg) for arg in fn.args)
+        try:
+            ret = self.generate(node.body, lookup)
+        except CodegenError:
+            # leave a plain declaration behind so the function can be defined again
+            del fn.blocks[:]
+            raise
+        finally:
+            for name, value in shadowed:
+                if value is _MISSING:
+                    lookup.pop(name, None)
+                else:
+                    lookup[name] = value
+        self.builder.ret(ret)
+        return fn
@@ -1,11 +1,11 @@
-from typing import Callable
-from enum import Enum
-from io import TextIOBase
+from typing import Any, ClassVar, Dict, FrozenSet, Pattern, TextIO, Union
+from enum import IntEnum
 
+import re
 import sys
 
 
-class TokenType(Enum):
+class TokenType(IntEnum):
     EOF = -1
     DEF = -2
     EXTERN = -3
@@ -14,76 +14,127 @@ class TokenType(Enum):
     OP = -6
 
 
+_TYPE_NAME = {token_type: token_type.name for token_type in TokenType}
+
+
 class Token:
-    GENERIC_TOKEN_TYPES = [TokenType.NUMBER, TokenType.IDENTIFIER, TokenType.OP]
+    GENERIC_TOKEN_TYPES: ClassVar[FrozenSet[TokenType]] = frozenset([TokenType.NUMBER, TokenType.IDENTIFIER, TokenType.OP])
 
-    def __init__(self, token_type: TokenType, **kwargs):
+    def __init__(self, token_type: TokenType, value: Union[str, float, None] = None):
         self.type = token_type
-        if self.type in Token.GENERIC_TOKEN_TYPES:
-            self.value = kwargs["value"]
-        else:
-            self.value = self.type.name
+        self.value: Any = _TYPE_NAME[token_type] if value is None else value
 
-    def __str__(self):
+    def __str__(self) -> str:
         return repr(self)
 
-    def __repr__(self):
+    def __repr__(self) -> str:
         if self.type not in Token.GENERIC_TOKEN_TYPES:
-            return f"Token(token_type={self.type})"
+            return f"Token(token_type=TokenType.{_TYPE_NAME[self.type]})"
         else:
-            return f"Token(token_type={self.type}, value={repr(self.value)})"
+            return f"Token(token_type=TokenType.{_TYPE_NAME[self.type]}, value={repr(self.value)})"
+
+
+_DEF = sys.intern("def")
+_EXTERN = sys.intern("extern")
+
+_KEYWORD_TOKS = {
+    TokenType.DEF: Token(TokenType.DEF),
+    TokenType.EXTERN: Token(TokenType.EXTERN),
+    TokenType.EOF: Token(TokenType.EOF),
+}
+_OP_CACHE: Dict[str, Token] = {}
+
+# whitespace and comments running until eol or eof
+_SKIP_RE = re.compile(r"(?:\s+|#[^\n]*(?:\n|$))*")
+_ID_RE = re.compile(r"[^\W_]*")
+_DIGITS_RE = re.compile(r"\d*")
 
 
 class Lexer:
-    def __init__(self, fp: TextIOBase):
+    def __init__(self, fp: TextIO):
         self.fp = fp
-        self.current_token : Token = None
+        self.tok_type = TokenType.EOF
+        self.tok_value: Any = ""
+        self.buf = ""
+        self.pos = 0
         self.last_char = " "
+        self._eof = False
 
     def next_token(self) -> Token:
-        self._read_while(str.isspace)
+        """Scan the next token and return it as a Token object."""
+        self.advance()
+        if self.tok_type is TokenType.OP:
+            token = _OP_CACHE.get(self.tok_value)
+            if token is None:
+                token = _OP_CACHE[self.tok_value] = Token(TokenType.OP, value=self.tok_value)
+            return token
+        elif self.tok_type in Token.GENERIC_TOKEN_TYPES:
+            return Token(self.tok_type, value=self.tok_value)
+        else:
+            return _KEYWORD_TOKS[self.tok_type]
+
+    def advance(self) -> None:
+        """Scan the next token into tok_type and tok_value."""
+        self._read_while(_SKIP_RE)
         if self.last_char.isalpha():
             # identifier or def or extern
-            word = self._read_while(str.isalnum)
-            if word == "def":
-                self.current_token = Token(TokenType.DEF)
-            elif word == "extern":
-                self.current_token = Token(TokenType.EXTERN)
+            word = sys.intern(self._read_while(_ID_RE))
+            if word is _DEF:
+                self.tok_type = TokenType.DEF
+            elif word is _EXTERN:
+                self.tok_type = TokenType.EXTERN
             else:
-                self.current_token = Token(TokenType.IDENTIFIER, value=word)
+                self.tok_type = TokenType.IDENTIFIER
+            self.tok_value = word
         elif self.last_char.isdigit() or self.last_char == ".":
             # number
-            word = self._read_while(str.isdigit)
+            word = self._read_while(_DIGITS_RE)
             if self.last_char == ".":
                 word += "."
                 self._eat(1)
-                word += self._read_while(str.isdigit)
-            self.current_token = Token(TokenType.NUMBER, value=float(word))
-        elif self.last_char == "#":
-            # comment until eof or eol
-            self._read_while(lambda x: x not in ["\n", "\r", ""])
-            self._eat(1)
+                word += self._read_while(_DIGITS_RE)
+            self.tok_type = TokenType.NUMBER
+            self.tok_value = float(word)
         elif self.last_char == "":
             # EOF
-            self.current_token = Token(TokenType.EOF)
+            self.tok_type = TokenType.EOF
+            self.tok_value = ""
         else:
-            self.current_token = Token(TokenType.OP, value=self.last_char)
+            self.tok_type = TokenType.OP
+            self.tok_value = sys.intern(self.last_char)
             self._eat(1)
 
-        return self.current_token
-
-    def _read_while(self, predicate: Callable[[str], bool]):
+    def _read_while(self, pattern: Pattern[str]) -> str:
         word = ""
-        while predicate(self.last_char):
-            word += self.last_char
-            self.last_char = self.fp.read(1)
+        while True:
+            match = pattern.match(self.buf, self.pos)
+            assert match is not None  # every pattern accepts the empty string
+            word += match.group(0)
+            self.pos = match.end()
+            # a run can only continue past the end of the buffer
+            if self.pos < len(self.buf) or not self._fill():
+                break
+        self.last_char = self.buf[self.pos:self.pos + 1]
         return word
 
-    def _eat(self, n: int):
-        self.last_char = self.fp.read(n)
+    def _eat(self, n: int) -> None:
+        self.pos += n
+        if self.pos >= len(self.buf):
+            self._fill()
+        self.last_char = self.buf[self.pos:self.pos + 1]
+
+    def _fill(self) -> bool:
+        """Read the next line into the buffer, return False on EOF."""
+        if self._eof:
+            # a terminal keeps answering reads after ctrl-d, don't block on it
+            return False
+        self.buf = self.fp.readline()
+        self.pos = 0
+        self._eof = self.buf == ""
+        return not self._eof
 
 
-def main():
+def main() -> None:
     l = Lexer(sys.stdin)
     while True:
         tok = l.next_token()
@@ -3,7 +3,7 @@ import sys
 
 
 def main():
-    p = parser.Parser(sys.stdin)
+    p = parser.Parser(sys.stdin, verbose="-v" in sys.argv[1:])
     p.parse()
 
 
@@ -1,15 +1,25 @@
-from lexer import Lexer, Token, TokenType
-from typing import List
-from io import TextIOBase
+from lexer import Lexer, TokenType
+from typing import ClassVar, List, Sequence, TextIO, Union
+import operator
+import sys
 import codegen
 
+# the lexer interns every operator, so these compare by identity
+_LP = sys.intern("(")
+_RP = sys.intern(")")
+_COMMA = sys.intern(",")
+_COLON = sys.intern(":")
+_SEMI = sys.intern(";")
+
 class Expr:
-    pass
+    __slots__ = ()
 
 
 class NumebrExpr(Expr):
     """Number expression, e.g. 5"""
 
+    __slots__ = ("value",)
+
     def __init__(self, value: float):
         self.value = value
 
@@ -20,6 +30,8 @@ class NumebrExpr(Expr):
 class VariableExpr(Expr):
     """Variable expression, e.g. x"""
 
+    __slots__ = ("var_name",)
+
     def __init__(self, var_name: str):
         self.var_name = var_name
 
@@ -30,6 +42,8 @@ class VariableExpr(Expr):
 class BinaryOpExpr(Expr):
     """Binary opeartion expression, e.g. x + y"""
 
+    __slots__ = ("op", "lhs", "rhs")
+
     def __init__(self, op: str, lhs: Expr, rhs: Expr):
         self.op = op
         self.lhs = lhs
@@ -42,7 +56,9 @@ class BinaryOpExpr(Expr):
 class CallExpr(Expr):
     """Function call expression, e.g. f(x, y)"""
 
-    def __init__(self, callee: str, args: List[Expr]):
+    __slots__ = ("callee", "args")
+
+    def __init__(self, callee: str, args: Sequence[Expr]):
         self.callee = callee
         self.args = args
 
@@ -53,6 +69,8 @@ class CallExpr(Expr):
 class Prototype:
     """Function prototype statement, e.g. extern def f(x y z)"""
 
+    __slots__ = ("name", "args")
+
     def __init__(self, name: str, args: List[str]):
         self.name = name
         self.args = args
@@ -64,11 +82,14 @@ class Prototype:
 class Function:
     """Function statement. e.g e.g. def f(n) n + 1"""
 
-    anon_counter = 0
+    __slots__ = ("proto", "body", "anonymous")
+
+    anon_counter: ClassVar[int] = 0
 
-    def __init__(self, proto: Prototype, body: Expr):
+    def __init__(self, proto: Prototype, body: Expr, anonymous: bool = False):
         self.proto = proto
         self.body = body
+        self.anonymous = anonymous
 
     def __repr__(self):
         return f"Function(proto={repr(self.proto)}, body={repr(self.body)})"
@@ -77,13 +98,21 @@ class Function:
     def create_anonymous(cls, body):
         proto = Prototype(f"_anon{cls.anon_counter}", [])
         cls.anon_counter += 1
-        return cls(proto, body)
+        return cls(proto, body, anonymous=True)
 
 
 class ParseError(Exception):
     pass
 
 
+_FOLD_BINOPS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "<": lambda lhs, rhs: 1.0 if lhs < rhs else 0.0,
+}
+
+
 class Parser:
     """Parser to parse text."""
 
@@ -94,74 +123,72 @@ class Parser:
         "*": 40,
     }
 
-    def __init__(self, fp: TextIOBase):
+    def __init__(self, fp: TextIO, verbose: bool = False):
         self.lexer = Lexer(fp)
-
-    @property
-    def cur_tok_precedence(self):
-        if self.cur_tok.type != TokenType.OP:
-            return -1 # not a binop
-        if self.cur_tok.value in type(self).binop_precedence:
-            return type(self).binop_precedence[self.cur_tok.value]
-        else:
-            return -1 # not a binop
-
-    @property
-    def cur_tok(self):
-        return self.lexer.current_token
-
-    def next_token(self):
-        self.lexer.next_token()
-        # print(self.cur_tok)
-        return self.cur_tok
-
-    def _parse_numberexpr(self):
+        self.tok_type = self.lexer.tok_type
+        self.tok_value = self.lexer.tok_value
+        self.verbose = verbose
+        self._scratch: List[Expr] = []
+
+    def _advance(self) -> None:
+        lexer = self.lexer
+        lexer.advance()
+        self.tok_type = lexer.tok_type
+        self.tok_value = lexer.tok_value
+
+    def _parse_numberexpr(self) -> NumebrExpr:
         """Parse numberexpr, e.g. 5
 
         numberexpr ::= number"""
-        expr = NumebrExpr(self.cur_tok.value)
-        self.next_token()
+        expr = NumebrExpr(self.tok_value)
+        self._advance()
         return expr
 
-    def _parse_parenexpr(self):
+    def _parse_parenexpr(self) -> Expr:
         """Parse parenexpr, e.g. (1 + 3*x)
 
         parenexpr ::= '(' expr ')'"""
-        self.next_token()  # eat (
+        self._advance()  # eat (
         expr = self._parse_expr()
-        if self.cur_tok.type != TokenType.OP or self.cur_tok.value != ")":
-            raise ParseError(f"Expected ), got {self.cur_tok.value}")
-        self.next_token()  # eat )
+        if self.tok_type is not TokenType.OP or self.tok_value is not _RP:
+            raise ParseError(f"Expected ), got {self.tok_value}")
+        self._advance()  # eat )
         return expr
 
-    def _parse_identifier_expr(self):
+    def _parse_identifier_expr(self) -> Expr:
         """Parse identifier expressions, e.g. var or f(x, y, z)
 
         identifierexpr
             ::= identifier
             ::= identifier '(' expression* ')'
         """
-        identifier_name = self.cur_tok.value
-        self.next_token()  # eat identifier name
-        if self.cur_tok.value != '(':
+        identifier_name = self.tok_value
+        self._advance()  # eat identifier name
+        if self.tok_value is not _LP:
             return VariableExpr(identifier_name)
-        self.next_token()  # eat (
-
-        args = []
-        if self.cur_tok.value != ')':
-            while True:
-                args.append(self._parse_expr())
-                if self.cur_tok.value == ')':
-                    break
-                if self.cur_tok.value != ',':
-                    raise ParseError(f"Expected , or ) but got {self.cur_tok.value}")
-                self.next_token()  # eat ,
-
-        self.next_token()  # eat )
+        self._advance()  # eat (
+
+        # arguments of nested calls are stacked on one shared list
+        scratch = self._scratch
+        start = len(scratch)
+        try:
+            if self.tok_value is not _RP:
+                while True:
+                    scratch.append(self._parse_expr())
+                    if self.tok_value is _RP:
+                        break
+                    if self.tok_value is not _COMMA:
+                        raise ParseError(f"Expected , or ) but got {self.tok_value}")
+                    self._advance()  # eat ,
+            args = tuple(scratch[start:])
+        finally:
+            del scratch[start:]
+
+        self._advance()  # eat )
 
         return CallExpr(identifier_name, args)
 
-    def _parse_primary(self):
+    def _parse_primary(self) -> Expr:
         """Parse primary expresison.
 
         primary
@@ -169,23 +196,24 @@ class Parser:
             ::= parenexpr
             ::= identifierexpr
         """
-        if self.cur_tok.type == TokenType.NUMBER:
+        if self.tok_type is TokenType.NUMBER:
             return self._parse_numberexpr()
-        elif self.cur_tok.type == TokenType.IDENTIFIER:
+        elif self.tok_type is TokenType.IDENTIFIER:
             return self._parse_identifier_expr()
-        elif self.cur_tok.type == TokenType.OP and self.cur_tok.value == '(':
+        elif self.tok_type is TokenType.OP and self.tok_value is _LP:
             return self._parse_parenexpr()
         else:
-            raise ParseError(f"Got unexpected token {self.cur_tok.value} in expresison")
+            raise ParseError(f"Got unexpected token {self.tok_value} in expresison")
 
-    def _parse_expr(self):
+    def _parse_expr(self) -> Expr:
         """Parse expression"""
         lhs = self._parse_primary()
         return self._parse_bin_op_rhs(lhs)
 
-    def _parse_bin_op_rhs(self, lhs, min_precedence=0):
+    def _parse_bin_op_rhs(self, lhs: Expr, min_precedence: int = 0) -> Expr:
+        binop_precedence = self.binop_precedence
         while True:
-            op_precedence = self.cur_tok_precedence
+            op_precedence = binop_precedence.get(self.tok_value, -1) if self.tok_type is TokenType.OP else -1
             if op_precedence < min_precedence:
                 # x + a * b * c + d
                 #       ^       ^ we are here
@@ -194,10 +222,10 @@ class Parser:
                 return lhs
             # a + b * c * d
             #           ^ this case
-            bin_op = self.cur_tok.value
-            self.next_token()  # eat bin_op
+            bin_op = self.tok_value
+            self._advance()  # eat bin_op
             rhs = self._parse_primary()
-            if op_precedence < self.cur_tok_precedence:
+            if self.tok_type is TokenType.OP and op_precedence < binop_precedence.get(self.tok_value, -1):
                 # a + b + c * d
                 #           ^ we are here
                 #   ^ _parse_bin_op_rhs invoked here with lhs = a
@@ -205,78 +233,102 @@ class Parser:
                 # should pass rhs = c to _parse_bin_op_rhs as lhs to group as (c * d)
                 rhs = self._parse_bin_op_rhs(rhs, op_precedence + 1)
 
-            lhs = BinaryOpExpr(bin_op, lhs, rhs)
+            if type(lhs) is NumebrExpr and type(rhs) is NumebrExpr and bin_op in _FOLD_BINOPS:
+                # fold literal arithmetic, `<` on literals matches the ordered fcmp
+                lhs = NumebrExpr(_FOLD_BINOPS[bin_op](lhs.value, rhs.value))
+            else:
+                lhs = BinaryOpExpr(bin_op, lhs, rhs)
 
-    def _parse_prototype(self):
+    def _parse_prototype(self) -> Prototype:
         """Parse prototype expression.
 
         prototype
             ::= id '(' id* ')'
         """
-        if self.cur_tok.type != TokenType.IDENTIFIER:
+        if self.tok_type is not TokenType.IDENTIFIER:
             raise ParseError("Expected identifier in function prototype")
-        id_name = self.cur_tok.value
-        self.next_token()  # eat id_name
-        if self.cur_tok.type != TokenType.OP or self.cur_tok.value != '(':
-            raise ParseError(f"Expexted ( got {self.cur_tok.value}")
+        id_name = self.tok_value
+        self._advance()  # eat id_name
+        if self.tok_type is not TokenType.OP or self.tok_value is not _LP:
+            raise ParseError(f"Expexted ( got {self.tok_value}")
         args = []
-        while self.next_token().type == TokenType.IDENTIFIER:
-            args.append(self.cur_tok.value)
-            self.next_token()
-            if self.cur_tok.value == ")":
+        self._advance()
+        while self.tok_type is TokenType.IDENTIFIER:
+            args.append(self.tok_value)
+            self._advance()
+            if self.tok_value is _RP:
                 break
-            if self.cur_tok.value != ",":
-                raise ParseError(f", expected, got {self.cur_tok}")
-        if self.cur_tok.type != TokenType.OP or self.cur_tok.value != ')':
-            raise ParseError(f"Expexted ) got {self.cur_tok.value}")
-        self.next_token()  # eat )
+            if self.tok_value is not _COMMA:
+                raise ParseError(f", expected, got {self.tok_value}")
+            self._advance()  # eat ,
+        if self.tok_type is not TokenType.OP or self.tok_value is not _RP:
+            raise ParseError(f"Expexted ) got {self.tok_value}")
+        self._advance()  # eat )
         return Prototype(id_name, args)
 
-    def _parse_definition(self):
+    def _parse_definition(self) -> Function:
         """Parse definition expression.
 
         definition ::= 'def' prototype expression
         """
-        self.next_token()  # eat def
+        self._advance()  # eat def
         proto = self._parse_prototype()
-        if self.cur_tok.value != ':':
+        if self.tok_value is not _COLON:
             raise ParseError("Exprected : before function body")
-        self.next_token()  # eat :
+        self._advance()  # eat :
         body = self._parse_expr()
         return Function(proto, body)
 
-    def _parse_extern(self):
+    def _parse_extern(self) -> Prototype:
         """Parse extern expression.
 
         extern ::= 'extern' prototype
         """
-        self.next_token()  # eat 'extern'
+        self._advance()  # eat 'extern'
         return self._parse_prototype()
 
-    def _parse_top_level_expr(self):
+    def _parse_top_level_expr(self) -> Function:
         """Parse top level expression.
 
         toplevel ::= expression
         """
         return Function.create_anonymous(self._parse_expr())
 
-    def parse(self):
+    def parse(self) -> None:
         print("ready> ", end=None)
-        self.next_token()
+        self._advance()
         generator = codegen.IRGenerator()
+        jit = codegen.JITEngine()
+        node: Union[Function, Prototype]
         while True:
             print("ready> ", end=None)
-            if self.cur_tok.type == TokenType.EOF:
+            if self.tok_type is TokenType.EOF:
                 break
-            elif self.cur_tok.type == TokenType.DEF:
+            elif self.tok_type is TokenType.DEF:
                 node = self._parse_definition()
-            elif self.cur_tok.type == TokenType.EXTERN:
+            elif self.tok_type is TokenType.EXTERN:
                 node = self._parse_extern()
-            elif self.cur_tok.value == ';':
-                self.next_token()
+            elif self.tok_value is _SEMI:
+                self._advance()
                 continue
             else:
                 node = self._parse_top_level_expr()
-            print(repr(node))
-            print(generator.generate(node))
-        print(generator.module)
+                if type(node.body) is NumebrExpr:
+                    # literal arithmetic is already folded, not worth a trip through LLVM
+                    if self.verbose:
+                        print(repr(node))
+                    print(node.body.value)
+                    continue
+            if self.verbose:
+                print(repr(node))
+            try:
+                ir = generator.generate(node)
+                print(ir)
+                if isinstance(node, Function):
+                    if node.anonymous:
+                        print(jit.run(ir))
+                    else:
+                        jit.add_function(ir)
+            except codegen.CodegenError as e:
+                print(f"Error: {e}")
+        print(codegen.optimize(generator.module))